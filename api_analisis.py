@@ -1,16 +1,22 @@
 # api_analisis.py
-import os
 import json
 import time
-from typing import List
-from openai import OpenAI
+import asyncio
+import threading
+from io import StringIO
+from typing import Any, Dict, List, Union
+import fastjsonschema
+import numpy as np
+from api_openai import get_client, first_available_model, model_cache_tag
+from api_cache import cache_key, cache_get, cache_put
 
-# ================== OPENAI ==================
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise EnvironmentError("❌ Falta la variable de entorno OPENAI_API_KEY")
+try:
+    import orjson  # parseo/serialización JSON rápidos
+except ImportError:
+    orjson = None
 
-client = OpenAI(api_key=api_key)
+# ================== OPENAI ==================
+# Cliente, reintentos y OPENAI_MODEL: ver api_openai.py
 CANDIDATES_DEFAULT = ["gpt-4o", "gpt-4o-mini", "o3-mini"]
 
 # Usa [[JSON_DATA]] como marcador para evitar .format y llaves conflictivas
@@ -65,90 +71,245 @@ monto_total_contrato_MXN es costo_en_contrato
 [[JSON_DATA]]
 """.strip()
 
+# Forma exacta de la salida; con strict=True la API garantiza que la respuesta la cumple
+PARTIDA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "concepto": {"type": "string"},
+        "unidad": {"type": "string"},
+        "cantidad": {"type": "number"},
+        "costo_en_contrato": {"type": "number"},
+        "precio_estimado_mercado": {"type": "number"},
+        "diferencia": {"type": "number"},
+        "diferencia_%": {"type": "number"},
+        "observaciones": {"type": "string"},
+    },
+    "required": [
+        "concepto", "unidad", "cantidad", "costo_en_contrato",
+        "precio_estimado_mercado", "diferencia", "diferencia_%", "observaciones",
+    ],
+    "additionalProperties": False,
+}
+
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "resumen_general": {
+            "type": "object",
+            "properties": {
+                "costo_en_contrato": {"type": "number"},
+                "precio_estimado_mercado": {"type": "number"},
+                "diferencia_total": {"type": "number"},
+                "diferencia_porcentaje": {"type": "number"},
+                "credibilidad": {"type": "number"},
+            },
+            "required": [
+                "costo_en_contrato", "precio_estimado_mercado", "diferencia_total",
+                "diferencia_porcentaje", "credibilidad",
+            ],
+            "additionalProperties": False,
+        },
+        "partidas": {"type": "array", "items": PARTIDA_SCHEMA},
+        "alertas": {"type": "array", "items": {"type": "string"}},
+        "recomendaciones": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["resumen_general", "partidas", "alertas", "recomendaciones"],
+    "additionalProperties": False,
+}
+
+# Forma serializada estable; entra en la llave de caché para que cambiar el esquema invalide respuestas viejas
+_OUTPUT_SCHEMA_JSON = json.dumps(OUTPUT_SCHEMA, sort_keys=True)
+
+_VALIDADOR = None
+
+
+def validar_resultado(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Valida contra OUTPUT_SCHEMA; el validador se compila una sola vez, en el primer uso."""
+    global _VALIDADOR
+    if _VALIDADOR is None:
+        _VALIDADOR = fastjsonschema.compile(OUTPUT_SCHEMA)
+    return _VALIDADOR(data)
+
+# Plantilla partida una sola vez: cada request solo concatena
+_PROMPT_PREFIX, _PROMPT_SUFFIX = PROMPT_BASE.split("[[JSON_DATA]]")
+
+
+def _ajustar_partidas(contrato, mercado, diff_out, pct_out):
+    # Si el costo en contrato es 0, diferencia y porcentaje = 0
+    for i in range(contrato.shape[0]):
+        c = contrato[i]
+        if c != 0.0:
+            d = mercado[i] - c
+            diff_out[i] = d
+            pct_out[i] = d / c * 100.0
+        else:
+            diff_out[i] = 0.0
+            pct_out[i] = 0.0
+
+
+def _ajustar_partidas_numpy(contrato, mercado, diff_out, pct_out):
+    # Misma cuenta vectorizada con NumPy, para cuando numba no está instalado
+    con_contrato = contrato != 0
+    divisor = np.where(con_contrato, contrato, 1.0)
+    diff_out[:] = np.where(con_contrato, mercado - contrato, 0.0)
+    pct_out[:] = np.where(con_contrato, (mercado - contrato) / divisor * 100, 0.0)
+
+
+_KERNEL_PARTIDAS = None
+_KERNEL_LOCK = threading.Lock()
+
+
+def _kernel_partidas():
+    # numba se importa y compila en el primer uso, no al importar: los workers de extracción
+    # (spawn en Windows) re-importan este módulo vía api_master y no deben pagar ese costo
+    global _KERNEL_PARTIDAS
+    with _KERNEL_LOCK:
+        if _KERNEL_PARTIDAS is None:
+            try:
+                from numba import njit
+            except ImportError:
+                print("⚠️ numba no disponible; ajuste de partidas con NumPy")
+                _KERNEL_PARTIDAS = _ajustar_partidas_numpy
+                return _KERNEL_PARTIDAS
+            kernel = njit(cache=True, fastmath=True)(_ajustar_partidas)
+            kernel(np.ones(1), np.ones(1), np.empty(1), np.empty(1))
+            _KERNEL_PARTIDAS = kernel
+    return _KERNEL_PARTIDAS
+
+
+async def analizar_costos_por_api(
+    json_input: Union[str, Dict[str, Any]], model_candidates: List[str] = None, usar_cache: bool = True
+) -> str:
+    candidates = model_candidates or CANDIDATES_DEFAULT
+    # Si llega el dict ya parseado del extractor, se serializa una sola vez
+    if isinstance(json_input, dict):
+        if orjson:
+            json_input = orjson.dumps(json_input).decode()
+        else:
+            json_input = json.dumps(json_input, ensure_ascii=False)
+
+    # 0) Caché por contenido; usar_cache=False fuerza una respuesta nueva (y la re-guarda)
+    key = cache_key(PROMPT_BASE, _OUTPUT_SCHEMA_JSON, model_cache_tag(candidates), json_input)
+    if usar_cache:
+        cached = await cache_get(key)
+        if cached is not None:
+            try:
+                validar_resultado(cached[1])
+            except fastjsonschema.JsonSchemaException as e:
+                # Entrada que ya no cumple OUTPUT_SCHEMA: cuenta como fallo de caché
+                print(f"⚠️ Análisis en caché no cumple el esquema, se ignora: {e.message}")
+            else:
+                print("♻️ Análisis tomado de caché")
+                return cached[0]  # ya se guardó con el formato final
 
-def first_available_model(client: OpenAI, candidates: List[str]) -> str:
-    start = time.perf_counter()
-    selected = None
-    for m in candidates:
-        try:
-            params = {"model": m, "messages": [{"role": "user", "content": "ok"}]}
-            client.chat.completions.create(**{**params, "max_tokens": 1})
-            selected = m
-            break
-        except Exception:
-            continue
-    elapsed_ms = (time.perf_counter() - start) * 1000
-    if not selected:
-        raise RuntimeError("No se encontró un modelo disponible.")
-    print(f"🧠 Modelo seleccionado: {selected}  |  ⏱️ selección modelo: {elapsed_ms:.0f} ms")
-    return selected
-
-
-def analizar_costos_por_api(json_input: str, model_candidates: List[str] = None) -> str:
     # 1) Selección de modelo
-    model_id = first_available_model(client, model_candidates or CANDIDATES_DEFAULT)
+    model_id = await first_available_model(get_client(), candidates)
 
-    # 2) Construcción de prompt (sin .format; usamos replace del marcador)
+    # 2) Construcción de prompt (sin .format; prefijo + entrada + sufijo)
     t0 = time.perf_counter()
-    prompt = PROMPT_BASE.replace("[[JSON_DATA]]", json_input)
+    prompt = _PROMPT_PREFIX + json_input + _PROMPT_SUFFIX
     t1 = time.perf_counter()
     print(f"🧩 Construcción del prompt: {(t1 - t0) * 1000:.0f} ms")
 
-    # 3) Llamada a la API
-    t2 = time.perf_counter()
-    response = client.chat.completions.create(
-        model=model_id,
-        temperature=0,
-        messages=[{"role": "user", "content": prompt}],
-        response_format={"type": "json_object"}
-    )
-    t3 = time.perf_counter()
-    print(f"🌐 Llamada al modelo: {(t3 - t2) * 1000:.0f} ms")
-
-    # 4) Validación/parseo JSON
-    t4 = time.perf_counter()
-    json_text = response.choices[0].message.content
-    data = json.loads(json_text)
-
-    # Validaciones mínimas
-    assert "resumen_general" in data and "partidas" in data and "alertas" in data and "recomendaciones" in data, \
-        "El JSON no contiene las llaves requeridas"
-
-    # === 🔧 AJUSTES LÓGICOS Y NUMÉRICOS ===
-    def _round_num(x, nd):
-        return round(x, nd) if isinstance(x, (int, float)) else x
-
-    # Ajuste en resumen general
-    rg = data.get("resumen_general", {})
-    for k in ["costo_en_contrato", "precio_estimado_mercado", "diferencia_total"]:
-        if k in rg and isinstance(rg[k], (int, float)):
-            rg[k] = _round_num(rg[k], 2)
-    if "diferencia_porcentaje" in rg and isinstance(rg["diferencia_porcentaje"], (int, float)):
-        rg["diferencia_porcentaje"] = _round_num(rg["diferencia_porcentaje"], 4)
-
-    # Ajuste detallado por partida
-    for p in data.get("partidas", []):
-        costo_contrato = p.get("costo_en_contrato", 0)
-        costo_mercado = p.get("precio_estimado_mercado", 0)
-
-        # Si el costo en contrato es 0, diferencia y porcentaje = 0
-        if not costo_contrato or costo_contrato == 0:
-            p["diferencia"] = 0
-            p["diferencia_%"] = 0
-        else:
-            diff = costo_mercado - costo_contrato
-            p["diferencia"] = _round_num(diff, 2)
-            p["diferencia_%"] = _round_num((diff / costo_contrato) * 100, 4)
+    # El JIT del kernel (solo la primera vez) se compila mientras se espera al modelo
+    kernel_listo = asyncio.ensure_future(asyncio.to_thread(_kernel_partidas))
+    try:
+        # 3) Llamada a la API (en streaming: los tokens llegan conforme se generan)
+        t2 = time.perf_counter()
+        stream = await get_client().chat.completions.create(
+            model=model_id,
+            temperature=0,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "analisis", "schema": OUTPUT_SCHEMA, "strict": True},
+            },
+            stream=True,
+        )
+        buffer = StringIO()
+        rechazo = StringIO()
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            if choice.delta.refusal:
+                rechazo.write(choice.delta.refusal)
+            if not choice.delta.content:
+                continue
+            if not buffer.tell():
+                print(f"📡 Primer token: {(time.perf_counter() - t2) * 1000:.0f} ms")
+            buffer.write(choice.delta.content)
+        t3 = time.perf_counter()
+        print(f"🌐 Llamada al modelo: {(t3 - t2) * 1000:.0f} ms  |  {buffer.tell()} caracteres")
+
+        # Con json_schema estricto un rechazo llega en refusal (sin content) y un corte deja JSON a medias
+        if rechazo.tell():
+            raise RuntimeError(f"❌ El modelo rechazó la solicitud: {rechazo.getvalue()}")
+        if finish_reason != "stop":
+            raise RuntimeError(
+                f"❌ Respuesta incompleta del modelo (finish_reason={finish_reason}, {buffer.tell()} caracteres)"
+            )
+
+        # 4) Validación/parseo JSON
+        t4 = time.perf_counter()
+        json_text = buffer.getvalue()
+        data = orjson.loads(json_text) if orjson else json.loads(json_text)
+        validar_resultado(data)
+
+        # === 🔧 AJUSTES LÓGICOS Y NUMÉRICOS ===
+        def _round_num(x, nd):
+            return round(x, nd) if isinstance(x, (int, float)) else x
+
+        # Ajuste en resumen general
+        rg = data.get("resumen_general", {})
+        for k in ["costo_en_contrato", "precio_estimado_mercado", "diferencia_total"]:
+            if k in rg and isinstance(rg[k], (int, float)):
+                rg[k] = _round_num(rg[k], 2)
+        if "diferencia_porcentaje" in rg and isinstance(rg["diferencia_porcentaje"], (int, float)):
+            rg["diferencia_porcentaje"] = _round_num(rg["diferencia_porcentaje"], 4)
+
+        # Ajuste detallado por partida (kernel compilado con Numba, o NumPy si no está)
+        partidas = data.get("partidas", [])
+        if partidas:
+            def _num(x):
+                return float(x) if isinstance(x, (int, float)) else 0.0
+
+            contrato = np.array([_num(p.get("costo_en_contrato", 0)) for p in partidas], dtype=np.float64)
+            mercado = np.array([_num(p.get("precio_estimado_mercado", 0)) for p in partidas], dtype=np.float64)
+            diff = np.empty_like(contrato)
+            pct = np.empty_like(contrato)
+            kernel = await kernel_listo
+            kernel(contrato, mercado, diff, pct)
+            diff = np.round(diff, 2)
+            pct = np.round(pct, 4)
+            contrato_r = np.round(contrato, 2).tolist()
+            mercado_r = np.round(mercado, 2).tolist()
 
-        # Redondeos de campos
-        for campo in ["costo_en_contrato", "precio_estimado_mercado", "diferencia", "diferencia_%"]:
-            if campo in p and isinstance(p[campo], (int, float)):
-                p[campo] = _round_num(p[campo], 2 if campo != "diferencia_%" else 4)
+            for p, d, pc, c, m in zip(partidas, diff.tolist(), pct.tolist(), contrato_r, mercado_r):
+                p["diferencia"] = d
+                p["diferencia_%"] = pc
+                # Redondeos de campos (los enteros ya están redondeados)
+                if isinstance(p.get("costo_en_contrato"), float):
+                    p["costo_en_contrato"] = c
+                if isinstance(p.get("precio_estimado_mercado"), float):
+                    p["precio_estimado_mercado"] = m
+    finally:
+        # Rechazo, corte o sin partidas: no dejar la tarea del JIT huérfana
+        if not kernel_listo.done():
+            kernel_listo.cancel()
+        elif not kernel_listo.cancelled():
+            kernel_listo.exception()
 
     # === 🔧 REEMPLAZO FINAL JSON PRETTY ===
-    json_text = json.dumps(data, ensure_ascii=False, indent=2)
+    if orjson:
+        json_text = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+    else:
+        json_text = json.dumps(data, ensure_ascii=False, indent=2)
 
     t5 = time.perf_counter()
     print(f"✅ Validación/parseo: {(t5 - t4) * 1000:.0f} ms")
 
+    await cache_put(key, json_text)
     return json_text
@@ -0,0 +1,54 @@
+# api_cache.py  (CACHÉ: respuestas del modelo en disco, indexadas por hash de contenido)
+import os
+import json
+import uuid
+import hashlib
+from typing import Any, Optional, Tuple, Union
+import anyio
+
+try:
+    import orjson  # parseo/serialización JSON rápidos
+except ImportError:
+    orjson = None
+
+# Por defecto junto a los scripts; se puede mover con LLM_CACHE_DIR
+LLM_CACHE_DIR = os.getenv(
+    "LLM_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache"),
+)
+
+
+def cache_key(*partes: Union[str, bytes]) -> str:
+    """Hash estable (blake2b, 128 bits) de las partes que determinan la respuesta."""
+    h = hashlib.blake2b(digest_size=16)
+    for parte in partes:
+        h.update(parte.encode("utf-8") if isinstance(parte, str) else parte)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+async def cache_get(key: str) -> Optional[Tuple[str, Any]]:
+    """Devuelve (texto guardado, texto parseado); una entrada ilegible cuenta como fallo de caché."""
+    try:
+        contenido = await (anyio.Path(LLM_CACHE_DIR) / f"{key}.json").read_bytes()
+    except FileNotFoundError:
+        return None
+    try:
+        data = orjson.loads(contenido) if orjson else json.loads(contenido)
+        return contenido.decode("utf-8"), data
+    except ValueError:
+        print(f"⚠️ Entrada de caché corrupta, se ignora: {key}")
+        return None
+
+
+async def cache_put(key: str, json_text: str) -> None:
+    directorio = anyio.Path(LLM_CACHE_DIR)
+    await directorio.mkdir(parents=True, exist_ok=True)
+    # Temporal único en la misma carpeta + os.replace: nunca queda una entrada a medias
+    tmp = directorio / f"{key}.{uuid.uuid4().hex}.tmp"
+    try:
+        await tmp.write_text(json_text, encoding="utf-8")
+        await tmp.replace(directorio / f"{key}.json")
+    except BaseException:
+        await tmp.unlink(missing_ok=True)
+        raise
@@ -1,9 +1,19 @@
 import os
 import json
+import hashlib
+import asyncio
 import argparse
 import traceback
 import time
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Awaitable, List, TypeVar, Union
+import anyio
+
+try:
+    import orjson  # parseo/serialización JSON rápidos
+except ImportError:
+    orjson = None
+
+T = TypeVar("T")
 
 # ================== RUTAS ABSOLUTAS ==================
 BASE_DIR = r"C:\Users\Alfredo\Downloads\PapusPorMexico"
@@ -12,8 +22,11 @@ DEFAULT_OUT_FINAL = os.path.join(BASE_DIR, "resultado_final.json")
 DEFAULT_OUT_INTER = os.path.join(BASE_DIR, "contrato_intermedio.json")
 
 # ================== IMPORTS ==================
-from api_analisis import analizar_costos_por_api            # string JSON in -> string JSON out
-from api_parseo_pdfs import analizar_carpeta_obras          # folder -> string JSON
+from api_analisis import analizar_costos_por_api            # dict/string JSON in -> string JSON out (async)
+from api_analisis import validar_resultado                  # valida contra el esquema de salida completo
+from api_parseo_pdfs import analizar_carpeta_obras          # folder -> dict JSON (async)
+from api_parseo_pdfs import cerrar_pool_pdfs                # apaga el pool de extracción de PDFs
+from api_openai import aclose_client                        # cierra el cliente OpenAI compartido
 
 
 # ================== FUNCIONES AUXILIARES ==================
@@ -23,25 +36,40 @@ def _ensure_json_dict(maybe_json: Union[str, Dict[str, Any]], etiqueta: str) ->
         return maybe_json
     if isinstance(maybe_json, str):
         try:
-            return json.loads(maybe_json)
+            return orjson.loads(maybe_json) if orjson else json.loads(maybe_json)
         except Exception as e:
             raise ValueError(f"❌ {etiqueta}: no es JSON válido. Detalle: {e}")
     raise TypeError(f"❌ {etiqueta}: tipo no soportado ({type(maybe_json)}).")
 
 
-def _write_json(path: str, data: Dict[str, Any]) -> None:
-    """Guarda el JSON en disco con formato bonito."""
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+async def _write_json(path: str, data: Dict[str, Any]) -> None:
+    """Guarda el JSON en disco con formato bonito, sin bloquear el event loop."""
+    destino = anyio.Path(path)
+    await destino.parent.mkdir(parents=True, exist_ok=True)
+    if orjson:
+        await destino.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        await destino.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def _ejecutar(coro: Awaitable[T]) -> T:
+    """asyncio.run que además cierra el cliente OpenAI y el pool de PDFs al terminar."""
+    async def _con_cierre() -> T:
+        try:
+            return await coro
+        finally:
+            await aclose_client()
+            cerrar_pool_pdfs()
+    return asyncio.run(_con_cierre())
 
 
 # ================== FUNCIÓN PRINCIPAL ==================
-def analizar_obras_completo(
+async def analizar_obras_completo(
     folder_path: str,
     ruta_salida: Optional[str] = None,
     ruta_intermedio: Optional[str] = None,
     validar_campos_final: bool = True,
+    usar_cache: bool = True,
 ) -> Dict[str, Any]:
     """Ejecuta el flujo completo de análisis y mide los tiempos."""
     if not os.path.isdir(folder_path):
@@ -55,32 +83,29 @@ def analizar_obras_completo(
         # 1️⃣ EXTRACCIÓN DE CONTRATO
         print("\n🧩 Extrayendo contrato (analizar_carpeta_obras)...")
         t1 = time.perf_counter()
-        contrato_json_str = analizar_carpeta_obras(folder_path)
+        contrato_json = await analizar_carpeta_obras(folder_path, usar_cache=usar_cache)
         tiempos["extraccion"] = time.perf_counter() - t1
 
-        contrato_json = _ensure_json_dict(contrato_json_str, "Contrato (intermedio)")
         print(f"✅ Contrato extraído y validado ({tiempos['extraccion']:.2f}s).")
 
         if ruta_intermedio:
-            _write_json(ruta_intermedio, contrato_json)
+            await _write_json(ruta_intermedio, contrato_json)
             print(f"📝 JSON intermedio guardado en: {ruta_intermedio}")
 
         # 2️⃣ ANÁLISIS DE COSTOS
         print("\n📊 Analizando costos (analizar_costos_por_api)...")
         t2 = time.perf_counter()
-        final_json_str = analizar_costos_por_api(contrato_json_str)
+        final_json_str = await analizar_costos_por_api(contrato_json, usar_cache=usar_cache)
         tiempos["analisis_costos"] = time.perf_counter() - t2
 
         final_json = _ensure_json_dict(final_json_str, "Resultado final (análisis)")
         print(f"✅ Análisis de costos completado y validado ({tiempos['analisis_costos']:.2f}s).")
 
         if validar_campos_final:
-            faltantes = [k for k in ("resumen_general", "partidas", "alertas", "recomendaciones") if k not in final_json]
-            if faltantes:
-                raise KeyError(f"❌ JSON final sin llaves requeridas: {faltantes}")
+            validar_resultado(final_json)
 
         if ruta_salida:
-            _write_json(ruta_salida, final_json)
+            await _write_json(ruta_salida, final_json)
             print(f"💾 Resultado final guardado en: {ruta_salida}")
 
         tiempos["total"] = time.perf_counter() - t_inicio
@@ -103,36 +128,127 @@ def analizar_obras_completo(
         print(f"\n🏁 Fin del proceso. (Duración total: {tiempos['total']:.2f}s)\n")
 
 
+def _nombre_lote(carpeta: str) -> str:
+    # Nombre + hash corto de la ruta: dos obras con la misma carpeta final no se pisan
+    nombre = os.path.basename(os.path.normpath(carpeta))
+    sufijo = hashlib.blake2b(os.path.abspath(carpeta).encode("utf-8"), digest_size=4).hexdigest()
+    return f"{nombre}_{sufijo}"
+
+
+async def analizar_obras_lote(
+    carpetas: List[str],
+    dir_salida: Optional[str] = None,
+    dir_intermedio: Optional[str] = None,
+    max_concurrentes: int = 10,
+    validar_campos_final: bool = True,
+    usar_cache: bool = True,
+) -> Dict[str, Union[Dict[str, Any], Exception]]:
+    """Analiza varias carpetas en paralelo (concurrencia acotada); devuelve resultado o error por carpeta.
+
+    La extracción de PDFs de todas las carpetas comparte el pool de procesos de api_parseo_pdfs,
+    así que max_concurrentes solo acota las obras en vuelo, no los procesos.
+    """
+    if max_concurrentes < 1:
+        raise ValueError(f"max_concurrentes debe ser >= 1 (recibido: {max_concurrentes})")
+    sem = asyncio.Semaphore(max_concurrentes)
+    # Rutas repetidas se analizan una sola vez
+    carpetas = list(dict.fromkeys(os.path.abspath(c) for c in carpetas))
+
+    async def _una(carpeta: str) -> Dict[str, Any]:
+        nombre = _nombre_lote(carpeta)
+        ruta_salida = os.path.join(dir_salida, f"resultado_{nombre}.json") if dir_salida else None
+        ruta_intermedio = os.path.join(dir_intermedio, f"contrato_{nombre}.json") if dir_intermedio else None
+        async with sem:
+            return await analizar_obras_completo(
+                folder_path=carpeta,
+                ruta_salida=ruta_salida,
+                ruta_intermedio=ruta_intermedio,
+                validar_campos_final=validar_campos_final,
+                usar_cache=usar_cache,
+            )
+
+    resultados = await asyncio.gather(*[_una(c) for c in carpetas], return_exceptions=True)
+    return dict(zip(carpetas, resultados))
+
+
 # ================== ARGPARSE ==================
+def _entero_positivo(valor: str) -> int:
+    try:
+        n = int(valor)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"debe ser un entero >= 1 (recibido: {valor})")
+    return n
+
+
 def _build_arg_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(description="Master que orquesta extractor de PDFs y analizador de costos.")
     p.add_argument(
-        "carpeta",
-        nargs="?",
-        default=DEFAULT_PDFS_DIR,
-        help=f"Ruta a la carpeta con PDFs de la obra (default: {DEFAULT_PDFS_DIR})."
+        "carpetas",
+        nargs="*",
+        default=[DEFAULT_PDFS_DIR],
+        help=f"Ruta(s) a la(s) carpeta(s) con PDFs de la obra; con varias se analizan en lote (default: {DEFAULT_PDFS_DIR})."
     )
     p.add_argument(
         "--out", "-o",
         dest="ruta_salida",
         default=DEFAULT_OUT_FINAL,
-        help=f"Ruta del archivo JSON final (default: {DEFAULT_OUT_FINAL})."
+        help=f"Ruta del archivo JSON final; en modo lote se usa su carpeta (default: {DEFAULT_OUT_FINAL})."
     )
     p.add_argument(
         "--dump-intermedio", "-i",
         dest="ruta_intermedio",
         default=DEFAULT_OUT_INTER,
-        help=f"(Opcional) Ruta para guardar el JSON intermedio (default: {DEFAULT_OUT_INTER})."
+        help=f"(Opcional) Ruta para guardar el JSON intermedio; en modo lote se usa su carpeta (default: {DEFAULT_OUT_INTER})."
     )
     p.add_argument(
         "--no-validate",
         action="store_true",
-        help="Desactiva validación de llaves mínimas del JSON final."
+        help="Omite la validación extra del JSON final en el master (el analizador siempre valida la respuesta del modelo contra OUTPUT_SCHEMA)."
+    )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignora respuestas guardadas en caché y vuelve a consultar al modelo."
+    )
+    p.add_argument(
+        "--concurrencia", "-c",
+        type=_entero_positivo,
+        default=10,
+        help="Máximo de carpetas analizadas a la vez en modo lote (default: 10)."
     )
     return p
 
 
 # ================== MAIN ==================
+def _main_lote(args: argparse.Namespace) -> None:
+    dir_salida = os.path.dirname(args.ruta_salida) or "."
+    dir_intermedio = (os.path.dirname(args.ruta_intermedio) or ".") if args.ruta_intermedio else None
+    print(f"ℹ️ Modo lote: {len(args.carpetas)} carpetas, concurrencia {args.concurrencia}")
+    print(f"ℹ️ Guardando resultados en: {dir_salida} (resultado_<carpeta>_<hash>.json)")
+    if dir_intermedio:
+        print(f"ℹ️ Guardando intermedios en: {dir_intermedio} (contrato_<carpeta>_<hash>.json)")
+
+    resultados = _ejecutar(analizar_obras_lote(
+        args.carpetas,
+        dir_salida=dir_salida,
+        dir_intermedio=dir_intermedio,
+        max_concurrentes=args.concurrencia,
+        validar_campos_final=(not args.no_validate),
+        usar_cache=(not args.no_cache),
+    ))
+
+    print("\n📌 RESUMEN DEL LOTE:")
+    for carpeta, resultado in resultados.items():
+        if isinstance(resultado, Exception):
+            print(f"  ❌ {carpeta}: {type(resultado).__name__}: {resultado}")
+        else:
+            rg = resultado.get("resumen_general", {})
+            print(f"  ✅ {carpeta}: diferencia {rg.get('diferencia_porcentaje')}% | credibilidad {rg.get('credibilidad')}")
+    print("\n🏁 Fin del proceso.")
+
+
 def main():
     args = _build_arg_parser().parse_args()
 
@@ -140,7 +256,11 @@ def main():
     print("🧠 INICIANDO PROCESO DE ANÁLISIS DE OBRAS 🧩")
     print("============================================")
 
-    if args.carpeta == DEFAULT_PDFS_DIR:
+    if len(args.carpetas) > 1:
+        _main_lote(args)
+        return
+
+    if args.carpetas == [DEFAULT_PDFS_DIR]:
         print(f"ℹ️ Usando carpeta por defecto: {DEFAULT_PDFS_DIR}")
     if args.ruta_salida == DEFAULT_OUT_FINAL:
         print(f"ℹ️ Guardando salida final en: {DEFAULT_OUT_FINAL}")
@@ -148,12 +268,13 @@ def main():
         print(f"ℹ️ Guardando intermedio en: {DEFAULT_OUT_INTER}")
 
     try:
-        resultado = analizar_obras_completo(
-            folder_path=args.carpeta,
+        resultado = _ejecutar(analizar_obras_completo(
+            folder_path=args.carpetas[0],
             ruta_salida=args.ruta_salida,
             ruta_intermedio=args.ruta_intermedio,
             validar_campos_final=(not args.no_validate),
-        )
+            usar_cache=(not args.no_cache),
+        ))
 
         rg = resultado.get("resumen_general", {})
         print("\n📌 RESUMEN GENERAL:")
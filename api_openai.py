@@ -0,0 +1,109 @@
+# api_openai.py  (CLIENTE: cliente OpenAI compartido y selección de modelo)
+import os
+import time
+import asyncio
+import importlib.util
+from typing import Dict, List, Tuple
+import httpx
+from openai import AsyncOpenAI
+
+# ================== CONFIGURACIÓN ==================
+#   OPENAI_API_KEY      ← obligatoria; se revisa al crear el cliente, no al importar
+#   OPENAI_MODEL        ← opcional; usa ese modelo directo, sin sondear candidatos
+#   OPENAI_MAX_RETRIES  ← opcional; reintentos del SDK ante 429/5xx con backoff exponencial (default 5)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+
+# HTTP/2 solo si está instalado h2 (httpx[http2]); si no, HTTP/1.1
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+_client = None
+_client_loop = None
+
+
+def get_client() -> AsyncOpenAI:
+    """Cliente único para extractor y analizador: un solo pool de conexiones.
+
+    Las conexiones quedan ligadas al event loop que las abrió, así que si cambia
+    el loop (otro asyncio.run en el mismo proceso) se crea un cliente nuevo.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise EnvironmentError("❌ Falta la variable de entorno OPENAI_API_KEY")
+        http_client = httpx.AsyncClient(
+            http2=_HTTP2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+        )
+        _client = AsyncOpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, http_client=http_client)
+        _client_loop = loop
+    return _client
+
+
+async def aclose_client() -> None:
+    """Cierra el cliente compartido; llamar antes de que termine el asyncio.run que lo usó."""
+    global _client, _client_loop
+    if _client is not None:
+        client, _client, _client_loop = _client, None, None
+        await client.close()
+
+
+# Modelo elegido por lista de candidatos; evita re-sondear en cada llamada
+MODEL_CACHE_TTL_S = 3600
+_MODEL_CACHE: Dict[Tuple[str, ...], Tuple[str, float]] = {}
+# Sondeos en curso: llamadas concurrentes con la misma lista esperan el mismo sondeo
+_MODEL_PROBES: Dict[Tuple[str, ...], "asyncio.Future[str]"] = {}
+
+
+async def _probe_model(client: AsyncOpenAI, model: str) -> str:
+    params = {"model": model, "messages": [{"role": "user", "content": "ok"}]}
+    try:
+        await client.chat.completions.create(**{**params, "max_completion_tokens": 1})
+    except Exception:
+        await client.chat.completions.create(**{**params, "max_tokens": 1})
+    return model
+
+
+async def _select_model(client: AsyncOpenAI, candidates: List[str]) -> str:
+    start = time.perf_counter()
+    # Sondeo concurrente: ~1 RTT en lugar de N; gana el primero de la lista que responda bien
+    resultados = await asyncio.gather(*[_probe_model(client, m) for m in candidates], return_exceptions=True)
+    selected = None
+    for m, r in zip(candidates, resultados):
+        if not isinstance(r, Exception):
+            selected = m
+            break
+        print(f"⏭️ No disponible: {m}")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if not selected:
+        raise RuntimeError("No se encontró un modelo disponible.")
+    print(f"🧠 Modelo seleccionado: {selected}  |  ⏱️ selección modelo: {elapsed_ms:.0f} ms")
+    _MODEL_CACHE[tuple(candidates)] = (selected, time.monotonic())
+    return selected
+
+
+def model_cache_tag(candidates: List[str]) -> str:
+    """Identifica el modelo que respondería para las claves de caché, sin sondear la red."""
+    forced = os.getenv("OPENAI_MODEL")
+    return f"modelo={forced}" if forced else "candidatos=" + ",".join(candidates)
+
+
+async def first_available_model(client: AsyncOpenAI, candidates: List[str]) -> str:
+    forced = os.getenv("OPENAI_MODEL")
+    if forced:
+        return forced
+
+    key = tuple(candidates)
+    cached = _MODEL_CACHE.get(key)
+    if cached and time.monotonic() - cached[1] < MODEL_CACHE_TTL_S:
+        return cached[0]
+
+    probe = _MODEL_PROBES.get(key)
+    if probe is None:
+        probe = asyncio.ensure_future(_select_model(client, candidates))
+        _MODEL_PROBES[key] = probe
+        probe.add_done_callback(lambda _: _MODEL_PROBES.pop(key, None))
+    # shield: si se cancela un llamador, el sondeo sigue para los demás
+    return await asyncio.shield(probe)
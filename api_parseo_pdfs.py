@@ -1,23 +1,43 @@
 # api_parseo_pdfs.py  (EXTRACTOR: leer PDFs y armar JSON base)
 import os
 import json
-from typing import List
-from openai import OpenAI
-from PyPDF2 import PdfReader
+import time
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+import tiktoken
+import pymupdf
+from api_openai import get_client, first_available_model, model_cache_tag
+from api_cache import cache_key, cache_get, cache_put
+
+try:
+    import orjson  # parseo/serialización JSON rápidos
+except ImportError:
+    orjson = None
 
 # ================== CONFIGURACIÓN ==================
 # Antes de ejecutar:
 #   setx OPENAI_API_KEY "tu_api_key"   ← Windows (ejecutar una vez en cmd)
 #   export OPENAI_API_KEY="tu_api_key" ← Linux/Mac (solo sesión actual)
-
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise EnvironmentError("❌ Falta la variable de entorno OPENAI_API_KEY")
-
-client = OpenAI(api_key=api_key)
+# Opcional:
+#   OPENAI_MODEL, OPENAI_MAX_RETRIES  ← ver api_openai.py
 
 CANDIDATES_DEFAULT = ["gpt-4o", "gpt-4o-mini", "o3-mini", "o1"]
 
+# Tope de tokens del contenido de los PDFs que se manda en el prompt
+MAX_TOKENS_CONTENIDO = int(os.getenv("MAX_TOKENS_CONTENIDO", "100000"))
+# Si no se puede cargar el encoding (p. ej. sin red para bajar o200k_base) se recorta por caracteres
+_CHARS_POR_TOKEN = 4
+# Tras un fallo se vuelve a intentar cargar el encoding pasado este tiempo (segundos)
+_ENCODING_REINTENTO_S = 300
+_ENCODING = None
+_ENCODING_FALLO: Optional[float] = None
+_ENCODING_LOCK = threading.Lock()
+
 # ⚠️ IMPORTANTÍSIMO:
 # Usamos un marcador [[CONTENIDO]] para evitar .format y conflictos con llaves {}
 PROMPT_TEMPLATE = """
@@ -52,56 +72,179 @@ Contenido:
 [[CONTENIDO]]
 """.strip()
 
+# Plantilla partida una sola vez: cada request solo concatena
+_PROMPT_PREFIX, _PROMPT_SUFFIX = PROMPT_TEMPLATE.split("[[CONTENIDO]]")
+
 
 def extract_text_from_pdf(file_path: str) -> str:
-    reader = PdfReader(file_path)
-    parts = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        parts.append(text.strip())
-    return "\n".join(parts)
+    with pymupdf.open(file_path) as doc:
+        return "\n".join(page.get_text("text").strip() for page in doc)
 
 
-def read_pdfs_from_folder(folder_path: str) -> str:
-    if not os.path.isdir(folder_path):
+def _extract_one(path: str) -> Tuple[str, str]:
+    # Nivel de módulo para que los procesos del pool puedan hacer pickle de la función
+    return os.path.basename(path), extract_text_from_pdf(path)
+
+
+def _list_pdfs(folder_path: str) -> List[str]:
+    try:
+        # scandir trae el tipo de cada entrada en la misma lectura del directorio
+        with os.scandir(folder_path) as it:
+            entries = [e for e in it if e.name.lower().endswith(".pdf") and e.is_file()]
+    except (FileNotFoundError, NotADirectoryError):
         raise FileNotFoundError(f"No existe la carpeta: {folder_path}")
-    chunks = []
-    for name in sorted(os.listdir(folder_path)):
-        if name.lower().endswith(".pdf"):
-            ruta = os.path.join(folder_path, name)
-            print(f"✅ Leyendo: {name}")
-            chunks.append(f"\n\n### DOCUMENTO: {name}\n{extract_text_from_pdf(ruta)}")
-    content = "".join(chunks).strip()
+    return [e.path for e in sorted(entries, key=lambda e: e.name)]
+
+
+def _join_documents(documentos: List[Tuple[str, str]]) -> str:
+    content = "".join(f"\n\n### DOCUMENTO: {name}\n{text}" for name, text in documentos).strip()
     if not content:
         raise RuntimeError("No se encontró ningún PDF en la carpeta.")
     return content
 
 
-def first_available_model(client: OpenAI, candidates: List[str]) -> str:
-    for m in candidates:
+# Un solo pool de procesos para todo el módulo: en modo lote las carpetas comparten los mismos workers
+_PDF_WORKERS = min(os.cpu_count() or 1, 4)
+_PDF_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _PDF_POOL
+    if _PDF_POOL is None:
+        # spawn también en Linux: hacer fork con hilos vivos (to_thread, tiktoken, numba) puede colgarse
+        _PDF_POOL = ProcessPoolExecutor(
+            max_workers=_PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _PDF_POOL
+
+
+def _descartar_pool(pool: ProcessPoolExecutor) -> None:
+    # Sin esperar a los workers; lo pendiente se cancela. La siguiente llamada crea un pool nuevo
+    global _PDF_POOL
+    if _PDF_POOL is pool:
+        _PDF_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def cerrar_pool_pdfs() -> None:
+    """Apaga el pool de extracción sin esperar a los workers; lo pendiente se cancela."""
+    if _PDF_POOL is not None:
+        _descartar_pool(_PDF_POOL)
+
+
+def _log_leido(fut: "asyncio.Future[Tuple[str, str]]") -> None:
+    if not fut.cancelled() and fut.exception() is None:
+        print(f"✅ Leído: {fut.result()[0]}")
+
+
+async def read_pdfs_from_folder_async(folder_path: str) -> str:
+    """Extrae el texto de los PDFs en el pool compartido, sin bloquear el event loop."""
+    rutas = _list_pdfs(folder_path)
+    documentos: List[Tuple[str, str]] = []
+    if rutas:
+        loop = asyncio.get_running_loop()
+        pool = _get_pdf_pool()
+        futuros = []
         try:
-            params = {"model": m, "messages": [{"role": "user", "content": "ok"}]}
+            for r in rutas:
+                fut = loop.run_in_executor(pool, _extract_one, r)
+                fut.add_done_callback(_log_leido)
+                futuros.append(fut)
+            # gather conserva el orden alfabético de rutas
+            documentos = await asyncio.gather(*futuros)
+        except BrokenProcessPool:
+            # Un worker murió (PDF malformado que tumba MuPDF, OOM...): el pool ya no sirve
+            _descartar_pool(pool)
+            raise
+        except BaseException:
+            # Si un PDF falla, lo que falte de esta carpeta se cancela en vez de esperarlo
+            for f in futuros:
+                f.cancel()
+            raise
+    return _join_documents(documentos)
+
+
+def read_pdfs_from_folder(folder_path: str) -> str:
+    """Versión síncrona de read_pdfs_from_folder_async (para usar fuera de un event loop)."""
+    return asyncio.run(read_pdfs_from_folder_async(folder_path))
+
+
+def _get_encoding():
+    # Una sola carga aunque varias carpetas del lote lleguen a la vez; None = no disponible por ahora
+    global _ENCODING, _ENCODING_FALLO
+    with _ENCODING_LOCK:
+        reintentar = _ENCODING_FALLO is None or time.monotonic() - _ENCODING_FALLO >= _ENCODING_REINTENTO_S
+        if _ENCODING is None and reintentar:
             try:
-                client.chat.completions.create(**{**params, "max_completion_tokens": 1})
-            except Exception:
-                client.chat.completions.create(**{**params, "max_tokens": 1})
-            print(f"🧠 Modelo seleccionado: {m}")
-            return m
-        except Exception:
-            print(f"⏭️ No disponible: {m}")
-            continue
-    raise RuntimeError("No se encontró un modelo disponible.")
+                _ENCODING = tiktoken.encoding_for_model("gpt-4o")
+                _ENCODING_FALLO = None
+            except Exception as e:
+                print(f"⚠️ tiktoken no disponible ({type(e).__name__}: {e}); se recorta por caracteres")
+                _ENCODING_FALLO = time.monotonic()
+    return _ENCODING
+
+
+def _truncar(contenido: str, encoding, max_tokens: int) -> str:
+    if encoding is None:
+        max_chars = max_tokens * _CHARS_POR_TOKEN
+        if len(contenido) <= max_chars:
+            return contenido
+        print(f"✂️ Contenido truncado: {len(contenido)} → {max_chars} caracteres (~{max_tokens} tokens)")
+        return contenido[:max_chars]
+    toks = encoding.encode(contenido, disallowed_special=())
+    if len(toks) <= max_tokens:
+        return contenido
+    print(f"✂️ Contenido truncado: {len(toks)} → {max_tokens} tokens")
+    return encoding.decode(toks[:max_tokens])
 
 
-def analizar_carpeta_obras(folder_path: str, model_candidates: List[str] = None) -> str:
-    contenido = read_pdfs_from_folder(folder_path)
+def truncar_por_tokens(contenido: str, max_tokens: int = MAX_TOKENS_CONTENIDO) -> str:
+    return _truncar(contenido, _get_encoding(), max_tokens)
+
+
+def _hash_pdfs(rutas: List[str]) -> bytes:
+    # Hash de los bytes crudos: mucho más barato que extraer el texto
+    h = hashlib.blake2b(digest_size=16)
+    for ruta in rutas:
+        h.update(os.path.basename(ruta).encode("utf-8"))
+        with open(ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                h.update(bloque)
+    return h.digest()
+
+
+async def analizar_carpeta_obras(
+    folder_path: str, model_candidates: List[str] = None, usar_cache: bool = True
+) -> Dict[str, Any]:
+    candidates = model_candidates or CANDIDATES_DEFAULT
+    # Caché por contenido de los PDFs; usar_cache=False fuerza una respuesta nueva (y la re-guarda)
+    hash_pdfs, encoding = await asyncio.gather(
+        asyncio.to_thread(_hash_pdfs, _list_pdfs(folder_path)),
+        asyncio.to_thread(_get_encoding),
+    )
+    # El modo de recorte entra en la clave: un recorte por caracteres no debe servirse como si fuera por tokens
+    modo_recorte = "tiktoken" if encoding is not None else "chars"
+    key = cache_key(
+        PROMPT_TEMPLATE, str(MAX_TOKENS_CONTENIDO), modo_recorte, model_cache_tag(candidates), hash_pdfs
+    )
+    if usar_cache:
+        cached = await cache_get(key)
+        if cached is not None:
+            print("♻️ Contrato tomado de caché")
+            return cached[1]
+
+    # La extracción (procesos) y el sondeo de modelo (red) corren en paralelo
+    contenido, model_id = await asyncio.gather(
+        read_pdfs_from_folder_async(folder_path),
+        first_available_model(get_client(), candidates),
+    )
 
-    # 🔒 NADA de .format() aquí; usamos reemplazo del marcador
-    prompt = PROMPT_TEMPLATE.replace("[[CONTENIDO]]", contenido)
+    contenido = await asyncio.to_thread(_truncar, contenido, encoding, MAX_TOKENS_CONTENIDO)
 
-    model_id = first_available_model(client, model_candidates or CANDIDATES_DEFAULT)
+    # 🔒 NADA de .format() aquí; prefijo + contenido + sufijo
+    prompt = _PROMPT_PREFIX + contenido + _PROMPT_SUFFIX
 
-    response = client.chat.completions.create(
+    response = await get_client().chat.completions.create(
         model=model_id,
         temperature=0,
         messages=[{"role": "user", "content": prompt}],
@@ -109,5 +252,6 @@ def analizar_carpeta_obras(folder_path: str, model_candidates: List[str] = None)
     )
 
     json_text = response.choices[0].message.content
-    json.loads(json_text)  # valida JSON
-    return json_text
+    data = orjson.loads(json_text) if orjson else json.loads(json_text)  # valida JSON
+    await cache_put(key, json_text)
+    return data